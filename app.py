@@ -1,7 +1,8 @@
 import logging
+import os
 
 from datetime import datetime, timedelta
-from flask import Flask, request
+from flask import Flask, Response, make_response, request
 
 from arc2_core import Arc2Core
 from config import configure_logging
@@ -9,14 +10,32 @@ from config import configure_logging
 logging.getLogger(__name__).addHandler(logging.NullHandler())
 configure_logging()
 
-ARC2_CACHE_DIR = '/data/arc2'
+ARC2_CACHE_DIR = os.environ.get('ARC2_CACHE_DIR', '/data/arc2')
+ARC2_PREFETCH_DAYS = int(os.environ.get('ARC2_PREFETCH_DAYS', 0))
+ARC2_DISK_BUDGET_MB = int(os.environ.get('ARC2_DISK_BUDGET_MB', 0))
+ARC2_SAT_DAYS = int(os.environ.get('ARC2_SAT_DAYS', 0))
+ARC2_ROLLUPS = [period for period in os.environ.get('ARC2_ROLLUPS', '').split(',') if period]
+Arc2Core.FTP_SERVER = os.environ.get('ARC2_FTP_SERVER', Arc2Core.FTP_SERVER)
+
+# max neighbourhood radius in pixels for rainfall queries
+MAX_RADIUS = 50
+
+# max number of periods for rollup queries
+MAX_PERIODS = 1200
+
+# seconds between keepalive comments on event streams, max seconds a long-poll may wait
+EVENTS_KEEPALIVE = 15
+EVENTS_MAX_WAIT = 60
+# long-poll header set when 'after' could not be resumed from and events restart at the oldest one kept
+EVENTS_RESET_HEADER = 'X-Arc2-Events-Reset'
 
 app = Flask(__name__)
-cache = Arc2Core(ARC2_CACHE_DIR)
+cache = Arc2Core(ARC2_CACHE_DIR, ARC2_PREFETCH_DAYS, ARC2_DISK_BUDGET_MB * 1024 * 1024, rollups=ARC2_ROLLUPS, sat_days=ARC2_SAT_DAYS)
 
 @app.after_request
 def treat_as_plain_text(response):
-    response.headers["content-type"] = "text/plain"
+    if response.mimetype != 'text/event-stream':
+        response.headers["content-type"] = "text/plain"
     return response
 
 @app.route("/arc2/cache")
@@ -91,12 +110,113 @@ def arc2():
             raise Exception("provided days value {} not in range (1 .. 366)".format(days))            
     except Exception as e:
         return http_400_response("days value exception {}".format(e))
-        
+
+    # validate optional neighbourhood radius in pixels from query param 'radius'
+    try:
+        radius = int(request.args.get('radius', 0))
+        if not (radius >= 0 and radius <= MAX_RADIUS):
+            raise Exception("provided radius value {} not in range (0 .. {})".format(radius, MAX_RADIUS))
+    except Exception as e:
+        return http_400_response("radius value exception {}".format(e))
+
     try:
-        return cache.rainfall(latitude, longitude, from_date.strftime(Arc2Core.DATE_FORMAT), days), 200
+        date = from_date.strftime(Arc2Core.DATE_FORMAT)
+        (data, tag) = cache.rainfall_tagged(latitude, longitude, date, days, radius)
+        # clients sending the tag of an unchanged window get an empty 304 response
+        return make_response(data, 200, {'ETag': tag}).make_conditional(request)
     except Exception as e:
         return http_400_response("rainfall cache exception {}".format(e))
 
+@app.route("/arc2/rollup")
+def arc2rollup():
+    # ensure all parameters are provided
+    try: 
+        for name in ['lat', 'long', 'period', 'date', 'periods']:
+            if not name in request.args:
+                raise Exception("'{}' missing. mandatory query parameters: 'lat', 'long', 'period', 'date', 'periods'".format(name))
+    except Exception as e:
+        return http_400_response("required parameter {}".format(e))
+
+    # validate latitude and longitude from query params 'lat' and 'long'
+    try:
+        latitude = float(request.args.get('lat'))
+        longitude = float(request.args.get('long'))
+        if not (latitude >= -40.0 and latitude <= 40.0 and longitude >= -20.0 and longitude <= 55.0):
+            raise Exception("provided location {}/{} not in range (-40.0 .. 40.0)/(-20.0 .. 55.0)".format(latitude, longitude))
+    except Exception as e:
+        return http_400_response("location value exception: {}".format(e))
+
+    # validate period from query param 'period'
+    period = request.args.get('period')
+    if not period in cache.rollups:
+        return http_400_response("period value exception: provided period '{}' not one of {}".format(period, list(cache.rollups.keys())))
+
+    # validate date from query param 'date', the first period returned is the one containing it
+    try:
+        from_date = datetime.strptime(request.args.get('date'), Arc2Core.DATE_FORMAT).date()
+    except Exception as e:
+        return http_400_response("date value exception {}".format(e))
+
+    # validate periods from query param 'periods'
+    try:
+        periods = int(request.args.get('periods'))
+        if not (periods >= 1 and periods <= MAX_PERIODS):
+            raise Exception("provided periods value {} not in range (1 .. {})".format(periods, MAX_PERIODS))
+    except Exception as e:
+        return http_400_response("periods value exception {}".format(e))
+
+    try:
+        return cache.rollup(latitude, longitude, period, from_date.strftime(Arc2Core.DATE_FORMAT), periods), 200
+    except Exception as e:
+        return http_400_response("rollup cache exception {}".format(e))
+
+@app.route("/arc2/events")
+def arc2events():
+    # server-sent events, one per day filled. reconnecting clients resume after 'Last-Event-ID'
+    try:
+        after = int(request.headers.get('Last-Event-ID', request.args.get('after', cache.events.last_id)))
+    except Exception as e:
+        return http_400_response("after value exception {}".format(e))
+
+    def stream(after):
+        while True:
+            (events, reset) = cache.events.wait(after, EVENTS_KEEPALIVE)
+
+            # events after 'after' are lost (e.g. server restart), clients should resync from /arc2/cache
+            if reset:
+                after = events[0][0] - 1 if events else 0
+                yield "event: reset\ndata: {}\n\n".format(after)
+
+            if not events:
+                yield ": keepalive\n\n"
+
+            for (id, data) in events:
+                yield "id: {}\ndata: {}\n\n".format(id, data)
+                after = id
+
+    return Response(stream(after), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
+@app.route("/arc2/events/poll")
+def arc2events_poll():
+    # long-poll alternative to the event stream, returns 'id date status' lines of events after 'after'
+    try:
+        after = int(request.args.get('after', cache.events.last_id))
+    except Exception as e:
+        return http_400_response("after value exception {}".format(e))
+
+    try:
+        timeout = float(request.args.get('timeout', EVENTS_MAX_WAIT))
+        if not (timeout >= 0 and timeout <= EVENTS_MAX_WAIT):
+            raise Exception("provided timeout value {} not in range (0 .. {})".format(timeout, EVENTS_MAX_WAIT))
+    except Exception as e:
+        return http_400_response("timeout value exception {}".format(e))
+
+    (events, reset) = cache.events.wait(after, timeout)
+    headers = {EVENTS_RESET_HEADER: 'true'} if reset else {}
+    return ''.join("{} {}\n".format(id, data) for (id, data) in events), 200, headers
+
+
 def http_400_response(message):
     logging.error(message)
     return message, 400
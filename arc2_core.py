@@ -1,8 +1,11 @@
 import logging
 import numpy
 import os
+import re
 import shutil
 import sys
+import tempfile
+import threading
 import zipfile
 
 from contextlib import closing
@@ -11,6 +14,11 @@ from urllib import request
 
 from geotiff.geotiff import GeoTiff
 from config import configure_logging
+from events import EventHub
+from manifest import Manifest
+from prefetch import Prefetcher
+from rollup import Rollup
+from sat import SummedAreaTables
 
 class Arc2Core(object):
 
@@ -21,6 +29,7 @@ class Arc2Core(object):
     CACHE_START_DATE = CACHE_MIN_DATE
     CACHE_END_DATE = '20231231'
     DATE_FORMAT = '%Y%m%d'
+    TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S'
 
     SIZE_LAT = 801
     SIZE_LONG = 751
@@ -33,16 +42,27 @@ class Arc2Core(object):
     ZIP_FOLDER = './data'
     TMP_FOLDER = '{}/tmp'.format(ZIP_FOLDER)
 
+    # decoded day slices persisted in the download folder when a disk budget is set
+    SLICE_FOLDER = 'slices'
+    SLICE_FILE_TEMPLATE = 'africa_arc.{}.npz'
+    SLICE_PATTERN = re.compile(r'africa_arc\.(\d{8})\.npz')
+
     CACHE_INITIALIZED = 'initialized'
+    CACHE_ARCHIVED = 'archived'
+    CACHE_EVICTED = 'evicted'
     CACHE_NO_FILE_ON_SERVER ='404 ftp response'
 
+    # max days waiting to be backfilled for rollup queries
+    BACKFILL_DAYS = 366
+
     logging.getLogger(__name__).addHandler(logging.NullHandler())
     configure_logging()
 
-    def __init__(self, download_folder=ZIP_FOLDER):
+    def __init__(self, download_folder=ZIP_FOLDER, prefetch_days=0, disk_budget=None, rollups=(), sat_days=0):
         super().__init__()
 
         self.download_folder = download_folder
+        self.manifest = Manifest(download_folder, disk_budget)
 
         self.offset_start = datetime.strptime(Arc2Core.CACHE_START_DATE, Arc2Core.DATE_FORMAT).date().toordinal()
         self.offset_end = datetime.strptime(Arc2Core.CACHE_END_DATE, Arc2Core.DATE_FORMAT).date().toordinal()
@@ -56,8 +76,58 @@ class Arc2Core(object):
             # dtype=float)
         
         self.cache_content = days * [Arc2Core.CACHE_INITIALIZED]
+        self.cache_timestamp = days * [None]
         self.arc2sample = None
 
+        # 'date status' of each day filled or failed, for subscribers
+        self.events = EventHub()
+
+        # summed-area tables built at ingest for neighbourhood means, kept for the sat_days most recently used days.
+        # days without a table are averaged directly from the cube
+        self.cache_sat = SummedAreaTables(sat_days) if sat_days > 0 else None
+
+        # dekadal, monthly and/or seasonal totals, updated as days are ingested.
+        # about 325 MB (dekad), 108 MB (month) and 39 MB (season) for three years
+        self.rollups = {}
+        for period in rollups:
+            self.rollups[period] = Rollup(period, self.offset_start, self.offset_end, (Arc2Core.SIZE_LAT, Arc2Core.SIZE_LONG))
+
+        # per day sequence number, odd while a new slice is being swapped into the cube.
+        # published version of a day is half its sequence number
+        self._cache_seq = numpy.zeros(days, dtype=numpy.int64)
+        # previous slices of days currently being swapped, served to concurrent readers
+        self._cache_shadow = {}
+        self._cache_lock = threading.Lock()
+        # days currently being loaded and number of loads requests are waiting for
+        self._cache_loading = {}
+        self._demand_loads = 0
+
+        # days with a downloaded archive that are not yet loaded into the cube
+        for (date, entry) in self.manifest.entries.items():
+            idx = datetime.strptime(date, Arc2Core.DATE_FORMAT).date().toordinal() - self.offset_start
+
+            if 0 <= idx < days:
+                self.cache_content[idx] = "{} {}".format(Arc2Core.CACHE_ARCHIVED, os.path.join(download_folder, entry['file']))
+
+        # days whose archive was evicted, only the persisted slice is left
+        slice_folder = os.path.join(download_folder, Arc2Core.SLICE_FOLDER)
+        if os.path.isdir(slice_folder):
+            for file in os.scandir(slice_folder):
+                match = Arc2Core.SLICE_PATTERN.fullmatch(file.name)
+                if not match:
+                    continue
+
+                date = match.group(1)
+                idx = datetime.strptime(date, Arc2Core.DATE_FORMAT).date().toordinal() - self.offset_start
+
+                if 0 <= idx < days and date not in self.manifest.entries:
+                    self.cache_content[idx] = "{} {}".format(Arc2Core.CACHE_EVICTED, file.path)
+
+        # background loads: read-ahead of rainfall queries and backfill of the days of rollup queries
+        self.prefetcher = None
+        if prefetch_days > 0 or self.rollups:
+            self.prefetcher = Prefetcher(self, prefetch_days, 4 * prefetch_days + (Arc2Core.BACKFILL_DAYS if self.rollups else 0))
+
         logging.info("arc2 core initialized. cache dimension {}".format(self.cache.shape))
 
 
@@ -77,17 +147,152 @@ class Arc2Core(object):
         idx_from = day_first - self.offset_start
         idx_to = day_last - self.offset_start
 
-        return self._data_to_txt(day_first, days, self.cache_content[idx_from:idx_to])
+        status = [self._day_status(idx) for idx in range(idx_from, idx_to)]
+
+        return self._data_to_txt(day_first, len(status), status)
+
+
+    def _day_status(self, idx):
+        timestamp = self.cache_timestamp[idx]
+        timestamp = timestamp.strftime(Arc2Core.TIMESTAMP_FORMAT) if timestamp else '-'
+
+        return "{} v{} {}".format(self.cache_content[idx], self.cache_version(idx), timestamp)
+
+
+    def cache_version(self, idx):
+        return int(self._cache_seq[idx]) // 2
+
+
+    def cache_tag(self, date, days, seq=None):
+        # versions only ever increase, their sum changes whenever a day in the window is reloaded.
+        # seq is the snapshot of sequence numbers the data was read with, odd ones count as the previous version
+        if seq is None:
+            idx = datetime.strptime(date, Arc2Core.DATE_FORMAT).date().toordinal() - self.offset_start
+            seq = self._cache_seq[idx:idx + days]
+
+        total = int((numpy.asarray(seq) // 2).sum())
+
+        return '"{}-{}-{}"'.format(date, days, total)
+
 
+    def rainfall(self, latitude, longitude, date, days, radius=0):
+        return self.rainfall_tagged(latitude, longitude, date, days, radius)[0]
 
-    def rainfall(self, latitude, longitude, date, days):
+
+    def rainfall_tagged(self, latitude, longitude, date, days, radius=0):
+        # rainfall text together with the cache tag of the versions actually read
         self._ensure_cached_data(date, days)
 
         day_first = datetime.strptime(date, '%Y%m%d').date().toordinal()
         (lat, lng) = self._lat_long_to_pixel(latitude, longitude)
         idx = day_first - self.offset_start
 
-        return self._data_to_txt(day_first, days, self.cache[lat, lng, idx:idx + days])
+        if self.prefetcher:
+            self.prefetcher.observe((lat, lng), day_first, days)
+
+        if radius > 0:
+            (values, seq) = self._read_neighbourhood(lat, lng, radius, idx, idx + days)
+        else:
+            (values, seq) = self._read_pixel(lat, lng, idx, idx + days)
+
+        return (self._data_to_txt(day_first, days, values), self.cache_tag(date, days, seq))
+
+
+    def rollup(self, latitude, longitude, period, date, periods):
+        rollup = self.rollups[period]
+        day = datetime.strptime(date, Arc2Core.DATE_FORMAT).date().toordinal()
+
+        idx_from = max(0, rollup.period_index(day))
+        idx_to = min(rollup.periods(), idx_from + periods)
+
+        # rollups only live in memory: days of the requested periods not ingested yet are loaded in the background
+        # instead of within the request. totals cover the days loaded so far, see the day counts per period
+        day_first = max(self.offset_start, int(rollup.starts[idx_from]))
+        day_last = min(self.offset_end, int(rollup.starts[idx_to]) - 1, datetime.now().date().toordinal() - 1)
+        missing = self.prefetcher.backfill(range(day_first, day_last + 1))
+        if missing:
+            logging.info("rollup {} from {}: {} days not loaded yet, backfilling".format(period, date, missing))
+
+        (lat, lng) = self._lat_long_to_pixel(latitude, longitude)
+        (sums, counts) = rollup.read(lat, lng, idx_from, idx_to)
+
+        lines = []
+        for i in range(idx_to - idx_from):
+            start = rollup.starts[idx_from + i]
+            days = rollup.starts[idx_from + i + 1] - start
+            date = datetime.fromordinal(start).strftime(Arc2Core.DATE_FORMAT)
+            lines.append("{} {} {}/{}".format(date, sums[i], counts[i], days))
+
+        return "{}\n".format('\n'.join(lines))
+
+
+    def _read_neighbourhood(self, lat, lng, radius, idx_from, idx_to):
+        # mean over the (2 * radius + 1)^2 pixels around lat/lng, clipped at the borders
+        box = (max(0, lat - radius), min(Arc2Core.SIZE_LAT, lat + radius + 1), max(0, lng - radius), min(Arc2Core.SIZE_LONG, lng + radius + 1))
+        values = numpy.full(idx_to - idx_from, Arc2Core.NO_DATA)
+        seq = numpy.zeros(idx_to - idx_from, dtype=numpy.int64)
+
+        for i in range(idx_to - idx_from):
+            (values[i], seq[i]) = self._day_neighbourhood(idx_from + i, box)
+
+        return (values, seq)
+
+
+    def _day_neighbourhood(self, idx, box):
+        # lock free like _read_pixel: a day being swapped is averaged from its previous slice,
+        # a slice that changed while it was read is read again
+        (lat_from, lat_to, lng_from, lng_to) = box
+
+        while True:
+            seq = int(self._cache_seq[idx])
+
+            if seq == 0:
+                return (Arc2Core.NO_DATA, seq)
+
+            if seq % 2:
+                old = self._cache_shadow.get(idx)
+                if old is None:
+                    continue
+
+                return (Arc2Core._box_mean(old[lat_from:lat_to, lng_from:lng_to]), seq)
+
+            # with a table: four lookups independent of the neighbourhood size
+            table = self.cache_sat.get(idx, seq) if self.cache_sat else None
+            if table:
+                return (SummedAreaTables.mean(table, lat_from, lat_to, lng_from, lng_to, Arc2Core.NO_DATA), seq)
+
+            # without: cost grows with the neighbourhood size
+            values = self.cache[lat_from:lat_to, lng_from:lng_to, idx].copy()
+            if seq == self._cache_seq[idx]:
+                return (Arc2Core._box_mean(values), seq)
+
+
+    @staticmethod
+    def _box_mean(values):
+        # same arithmetic as the summed-area tables, both return identical means
+        valid = Arc2Core._valid(values)
+        return SummedAreaTables.to_mean(int(SummedAreaTables.units(values, valid).sum()), int(valid.sum()), Arc2Core.NO_DATA)
+
+
+    @staticmethod
+    def _valid(data):
+        return numpy.isfinite(data) & (data != Arc2Core.NO_DATA) & (data >= 0)
+
+
+    def _read_pixel(self, lat, lng, idx_from, idx_to):
+        # lock free read, retried when a day in the window got swapped meanwhile.
+        # days with a swap in progress are served from the previous slice
+        while True:
+            seq_before = self._cache_seq[idx_from:idx_to].copy()
+            shadow = dict(self._cache_shadow)
+            values = self.cache[lat, lng, idx_from:idx_to].copy()
+            seq_after = self._cache_seq[idx_from:idx_to]
+
+            if numpy.array_equal(seq_before, seq_after):
+                for i in numpy.flatnonzero(seq_before % 2):
+                    values[i] = shadow[idx_from + i][lat, lng]
+
+                return (values, seq_before)
 
 
     def _ensure_cached_data(self, date, days, force_reload=False):
@@ -96,22 +301,137 @@ class Arc2Core(object):
         offset_upper = min(offset_date + days, offset_today)
 
         for day in range(offset_date, offset_upper):
-            date_string = datetime.strftime(datetime.fromordinal(day), Arc2Core.DATE_FORMAT)
             idx = day - self.offset_start
 
-            if self.cache_content[idx] == Arc2Core.CACHE_INITIALIZED or force_reload: 
-                logging.info("updating cache for '{}'".format(date_string))
-                (status, message, data, tiff_file, zip_file) = self._get_rainfall_2d(date_string, force_reload)
+            if self._needs_load(idx) or force_reload: 
+                self._load_day(day, force_reload)
 
-                if data:
-                    self.cache[:, :, idx] = data
-                    self.cache_content[idx] = zip_file
-                    os.remove(tiff_file)
-                else:
-                    self.cache_content[idx] = "{} {}".format(message, zip_file)
+
+    def _needs_load(self, idx):
+        content = self.cache_content[idx]
+
+        if content.startswith(Arc2Core.CACHE_EVICTED + ' '):
+            return self.cache_version(idx) == 0
+
+        return content == Arc2Core.CACHE_INITIALIZED or content.startswith(Arc2Core.CACHE_ARCHIVED + ' ')
+
+
+    def _load_day(self, day, force_reload=False, demand=True):
+        date_string = datetime.strftime(datetime.fromordinal(day), Arc2Core.DATE_FORMAT)
+        idx = day - self.offset_start
+
+        if demand:
+            with self._cache_lock:
+                self._demand_loads += 1
+
+        try:
+            # only one thread loads a given day at a time. a waiting thread takes over when the day still
+            # needs loading afterwards (e.g. a failed prefetch) or when it asked for a reload itself
+            while True:
+                with self._cache_lock:
+                    loading = self._cache_loading.get(idx)
+
+                    if not loading:
+                        loading = self._cache_loading[idx] = threading.Event()
+                        break
+
+                loading.wait()
+
+                if not (force_reload or self._needs_load(idx)):
+                    return
+
+            try:
+                self._fetch_day(idx, date_string, force_reload, demand)
+            finally:
+                with self._cache_lock:
+                    del self._cache_loading[idx]
+
+                loading.set()
+
+        finally:
+            if demand:
+                with self._cache_lock:
+                    self._demand_loads -= 1
+
+
+    def _fetch_day(self, idx, date_string, force_reload, demand):
+        logging.info("updating cache for '{}'{}".format(date_string, '' if demand else ' (prefetch)'))
+        (status, message, data, zip_file) = self._get_rainfall_2d(date_string, force_reload)
+
+        if data is not None:
+            self._swap_day(idx, data, zip_file)
+
+            for date in self.manifest.evict(self._archive_evictable):
+                evicted = datetime.strptime(date, Arc2Core.DATE_FORMAT).date().toordinal() - self.offset_start
+                self.cache_content[evicted] = "{} {}".format(Arc2Core.CACHE_EVICTED, self._slice_path(date))
+        elif self.cache_version(idx) > 0:
+            logging.warning("reload for '{}' failed, keeping version {}".format(date_string, self.cache_version(idx)))
+            return
+        elif demand:
+            self.cache_content[idx] = "{} {}".format(message, zip_file)
+        else:
+            # day may not be published yet, leave it to a later demand load to record the failure
+            logging.info("prefetch for '{}' failed: {}".format(date_string, message))
+            return
+
+        self.events.publish("{} {}".format(date_string, self._day_status(idx)))
+
+
+    def _archive_evictable(self, date):
+        # only archives of days with a persisted slice may go, the cube itself only lives in memory
+        idx = datetime.strptime(date, Arc2Core.DATE_FORMAT).date().toordinal() - self.offset_start
+        return 0 <= idx < len(self.cache_content) and os.path.exists(self._slice_path(date))
+
+
+    def _slice_path(self, date_string):
+        return os.path.join(self.download_folder, Arc2Core.SLICE_FOLDER, Arc2Core.SLICE_FILE_TEMPLATE.format(date_string))
+
+
+    def _persist_slice(self, date_string, data):
+        # compressed float16 slice (about 60 KB), replaced atomically like the archives
+        path = self._slice_path(date_string)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        (fd, tmp_file_path) = tempfile.mkstemp(dir=os.path.dirname(path))
+
+        with os.fdopen(fd, 'wb') as f:
+            numpy.savez_compressed(f, slice=data)
+
+        os.replace(tmp_file_path, path)
+
+
+    def demand_loads(self):
+        return self._demand_loads
+
+
+    def _swap_day(self, idx, data, zip_file):
+        # data is fully decoded at this point, readers keep seeing the previous slice until the copy is done.
+        # the summed-area table is built from the slice as stored in the cube, before taking the lock
+        table = None
+        if self.cache_sat:
+            data = numpy.asarray(data, dtype=self.cache.dtype)
+            table = SummedAreaTables.build(data, Arc2Core._valid(data))
+
+        with self._cache_lock:
+            self._cache_shadow[idx] = self.cache[:, :, idx].copy()
+            self._cache_seq[idx] += 1
+            self.cache[:, :, idx] = data
+            self._cache_seq[idx] += 1
+            old = self._cache_shadow.pop(idx)
+
+            if table:
+                self.cache_sat.put(idx, int(self._cache_seq[idx]), table)
+
+            new = self.cache[:, :, idx]
+            (old_valid, new_valid) = (Arc2Core._valid(old), Arc2Core._valid(new))
+            for rollup in self.rollups.values():
+                rollup.update(self.offset_start + idx, old, old_valid, new, new_valid)
+
+            self.cache_content[idx] = zip_file
+            self.cache_timestamp[idx] = datetime.now()
 
 
     def _lat_long_to_pixel(self, latitude, longitude):
+        self._check_sample()
         location = self.arc2sample._convert_from_wgs_84(self.arc2sample.crs_code, [latitude, longitude])
         pix_lat = self.arc2sample._get_y_int(location[0])
         pix_lng = self.arc2sample._get_x_int(location[1])
@@ -119,38 +439,92 @@ class Arc2Core(object):
         return (pix_lat, pix_lng)
 
 
+    def _check_sample(self):
+        # the pixel grid is only known once a geotiff has been loaded
+        if not self.arc2sample:
+            raise ValueError("no arc2 geotiff loaded yet, pixel positions unknown")
+
+
+    def _lat_long_to_pixels(self, latitudes, longitudes):
+        # vectorized _lat_long_to_pixel for bulk lookups, pixels outside the grid are flagged in the returned mask
+        self._check_sample()
+        sample = self.arc2sample
+        location = sample._convert_from_wgs_84(sample.crs_code, [numpy.asarray(latitudes), numpy.asarray(longitudes)])
+        step_x = sample.tifShape[1] / (sample.tif_bBox[1][0] - sample.tif_bBox[0][0])
+        step_y = sample.tifShape[0] / (sample.tif_bBox[1][1] - sample.tif_bBox[0][1])
+
+        pix_lat = (step_y * (numpy.asarray(location[0]) - sample.tif_bBox[0][1])).astype(int)
+        pix_lng = (step_x * (numpy.asarray(location[1]) - sample.tif_bBox[0][0])).astype(int)
+        inside = (pix_lat >= 0) & (pix_lat < Arc2Core.SIZE_LAT) & (pix_lng >= 0) & (pix_lng < Arc2Core.SIZE_LONG)
+
+        return (pix_lat, pix_lng, inside)
+
+
     def _get_rainfall_2d(self, date_string, force_reload=False):
         filename_zip = Arc2Core.ZIP_FILE_TEMPLATE_ZIP.format(date_string)
         filename = Arc2Core.ZIP_FILE_TEMPLATE.format(date_string)
         local_file_path_zip = os.path.join(self.download_folder, filename_zip)
-        local_file_path = os.path.join(Arc2Core.TMP_FOLDER, filename)
         status = -1
         message = ''
 
-        # force reload: removing local zipped geotiff if available to trigger an ftp download
-        if force_reload and os.path.exists(local_file_path_zip):
-            os.remove(local_file_path_zip)
+        entry = self.manifest.get(date_string)
+        slice_path = self._slice_path(date_string)
 
-        # ensure we have the zipped geotiff        
-        if not os.path.exists(local_file_path_zip):
-            (status, message, file_name) = self._ftp_download_geotiff(filename_zip, local_file_path_zip)
+        # archive evicted earlier: load the persisted slice. the pixel grid is only known from a geotiff,
+        # so the first load after a restart goes through an archive
+        if not force_reload and not entry and self.arc2sample and os.path.exists(slice_path):
+            try:
+                with numpy.load(slice_path) as f:
+                    return (status, message, f['slice'], "{} {}".format(Arc2Core.CACHE_EVICTED, slice_path))
+            except Exception as e:
+                logging.warning("slice {} not readable, fetching the archive again. nested exception: {}".format(slice_path, e))
+
+        # ensure we have the zipped geotiff, on force reload the local file is only replaced after a successful download
+        if force_reload or not entry or not self._archive_valid(local_file_path_zip, entry):
+            (status, message, source_timestamp) = self._ftp_download_geotiff(filename_zip, local_file_path_zip)
 
             # something wrong with ftp download
             if status != 200:
-                return (status, message, None, None, filename_zip)
+                return (status, message, None, filename_zip)
+
+            self.manifest.add(date_string, local_file_path_zip, source_timestamp)
+        else:
+            self.manifest.touch(date_string)
+
+        # unzip into a private folder, concurrent loads of the same day must not share the tiff file
+        os.makedirs(Arc2Core.TMP_FOLDER, exist_ok=True)
+        tmp_folder = tempfile.mkdtemp(dir=Arc2Core.TMP_FOLDER)
 
-        # unzip and load geotiff
-        with zipfile.ZipFile(local_file_path_zip, 'r') as f:
-            f.extractall(Arc2Core.TMP_FOLDER)
+        try:
+            with zipfile.ZipFile(local_file_path_zip, 'r') as f:
+                f.extractall(tmp_folder)
 
-        gt = GeoTiff(local_file_path, crs_code=4236)
-        np2d = gt.read()
+            gt = GeoTiff(os.path.join(tmp_folder, filename), crs_code=4236)
+            np2d = numpy.asarray(gt.read()[:], dtype=numpy.half)
+        finally:
+            shutil.rmtree(tmp_folder, ignore_errors=True)
 
         # keep (arbitrary) geotiff to call methods later
         if not self.arc2sample:
             self.arc2sample = gt
 
-        return (status, message, np2d, local_file_path, local_file_path_zip)
+        # with a disk budget archives may only be evicted once their slice is persisted
+        if self.manifest.budget:
+            self._persist_slice(date_string, np2d)
+
+        return (status, message, np2d, local_file_path_zip)
+
+
+    def _archive_valid(self, local_file_path_zip, entry):
+        try:
+            if Manifest.checksum(local_file_path_zip) == entry['checksum']:
+                return True
+
+            logging.warning("checksum mismatch for {}, fetching it again".format(local_file_path_zip))
+        except OSError as e:
+            logging.warning("archive {} not readable, fetching it again. nested exception: {}".format(local_file_path_zip, e))
+
+        return False
 
 
     def _ftp_download_geotiff(self, filename_zip, local_file_path_zip):
@@ -158,14 +532,25 @@ class Arc2Core(object):
 
         logging.info("fetching {}, saving as {}".format(ftp_file_path, local_file_path_zip))
 
+        tmp_file_path = None
+
         try:
-            with closing(request.urlopen(ftp_file_path)) as r:
-                with open(local_file_path_zip, 'wb') as f:
+            (fd, tmp_file_path) = tempfile.mkstemp(dir=os.path.dirname(local_file_path_zip) or '.')
+
+            with os.fdopen(fd, 'wb') as f:
+                with closing(request.urlopen(ftp_file_path)) as r:
                     shutil.copyfileobj(r, f)
-            
-            return (200, "OK", f)
+                    source_timestamp = r.headers.get('Last-Modified')
+
+            # replace atomically, readers never see a partially downloaded archive
+            os.replace(tmp_file_path, local_file_path_zip)
+
+            return (200, "OK", source_timestamp)
         
         except Exception as e:
+            if tmp_file_path and os.path.exists(tmp_file_path):
+                os.remove(tmp_file_path)
+
             logging.warning("download failed, check that file exists on ftp server. nested exception: {}".format(e))
 
             if str(e) == "HTTP Error 404: Not Found":
@@ -0,0 +1,45 @@
+import threading
+
+from collections import deque
+
+class EventHub(object):
+    """numbered events for subscribers, newest HISTORY events are kept to let clients resume"""
+
+    HISTORY = 1000
+
+    def __init__(self):
+        super().__init__()
+
+        self.events = deque(maxlen=EventHub.HISTORY)
+        self.last_id = 0
+        self.condition = threading.Condition()
+
+
+    def publish(self, data):
+        with self.condition:
+            self.last_id += 1
+            self.events.append((self.last_id, data))
+            self.condition.notify_all()
+
+
+    def wait(self, after=None, timeout=None):
+        """returns (events with an id larger than after, reset), waits up to timeout seconds if there are none yet.
+        after None starts from the next event published.
+
+        reset is True when after cannot be resumed from: it is newer than the last id (ids restart with the
+        server) or older than the events kept. events then start with the oldest event kept and the
+        client should resync its state, e.g. from /arc2/cache
+        """
+        with self.condition:
+            if after is None:
+                after = self.last_id
+
+            oldest = self.events[0][0] if self.events else self.last_id + 1
+            reset = after > self.last_id or after < oldest - 1
+
+            if reset:
+                after = oldest - 1
+
+            self.condition.wait_for(lambda: self.last_id > after, timeout)
+
+            return ([event for event in self.events if event[0] > after], reset)
@@ -0,0 +1,180 @@
+import argparse
+import csv
+import gzip
+import logging
+import multiprocessing
+import numpy
+import os
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+
+from arc2_core import Arc2Core
+from config import configure_logging
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+configure_logging()
+
+# pixels and locations per block, a block is read from the cube and written as one shard.
+# a worker holds (pixels + locations) x days float32 values at most
+BLOCK_SIZE = 4096
+BLOCK_LOCATIONS = 16384
+FORMATS = ['npz', 'csv']
+
+# threads loading days into the cube, mostly waiting for downloads
+LOADERS = 8
+
+# core shared with the worker processes (forked, the cube is not copied)
+_core = None
+
+
+def read_locations(file_name):
+    """reads 'lat' and 'long' columns of a csv file, ids from an optional 'id' column or the row number"""
+    ids = []
+    latitudes = []
+    longitudes = []
+
+    with open(file_name, newline='') as f:
+        for (row, record) in enumerate(csv.DictReader(f)):
+            ids.append(record.get('id') or str(row))
+            latitudes.append(float(record['lat']))
+            longitudes.append(float(record['long']))
+
+    return (numpy.array(ids), numpy.array(latitudes), numpy.array(longitudes))
+
+
+def plan_blocks(pix_lat, pix_lng, block_size, block_locations=BLOCK_LOCATIONS):
+    """groups locations by unique pixel into blocks of at most block_size pixels and block_locations locations
+    in cube order, the locations of a crowded pixel may be spread over several blocks.
+    returns (pixel lat, pixel long, location indices, index of the location's pixel in the block) per block"""
+    pixel = pix_lat * Arc2Core.SIZE_LONG + pix_lng
+    (unique, inverse) = numpy.unique(pixel, return_inverse=True)
+    order = numpy.argsort(inverse, kind='stable')
+    sorted_inverse = inverse[order]
+    blocks = []
+    start = 0
+
+    while start < len(order):
+        first = sorted_inverse[start]
+        end = min(int(numpy.searchsorted(sorted_inverse, first + block_size)), start + block_locations)
+        pixels = unique[first:sorted_inverse[end - 1] + 1]
+
+        blocks.append((pixels // Arc2Core.SIZE_LONG, pixels % Arc2Core.SIZE_LONG, order[start:end], sorted_inverse[start:end] - first))
+        start = end
+
+    return blocks
+
+
+def _extract_block(task):
+    (block, pix_lat, pix_lng, ids, latitudes, longitudes, pixel_index, idx_from, idx_to, dates, output, format) = task
+
+    # one fancy-indexed read per block, each pixel's days are contiguous in the cube
+    rainfall = _core.cache[pix_lat, pix_lng, idx_from:idx_to].astype(numpy.float32)[pixel_index]
+    file_name = os.path.join(output, 'rainfall-{:05d}.{}'.format(block, 'npz' if format == 'npz' else 'csv.gz'))
+
+    if format == 'npz':
+        numpy.savez_compressed(
+            file_name,
+            id=ids,
+            lat=latitudes,
+            long=longitudes,
+            pixel_lat=pix_lat[pixel_index],
+            pixel_long=pix_lng[pixel_index],
+            date=dates,
+            rainfall=rainfall)
+    else:
+        with gzip.open(file_name, 'wt', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['id', 'lat', 'long'] + list(dates))
+            for i in range(len(ids)):
+                writer.writerow([ids[i], latitudes[i], longitudes[i]] + rainfall[i].tolist())
+
+    return (block, len(ids))
+
+
+def load_days(core, date, days, loaders=LOADERS):
+    """loads the days of the range into the cube, downloads and decoding of different days run in parallel threads"""
+    day_first = datetime.strptime(date, Arc2Core.DATE_FORMAT).date().toordinal()
+    dates = [datetime.fromordinal(day).strftime(Arc2Core.DATE_FORMAT) for day in range(day_first, day_first + days)]
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=loaders) as executor:
+        for (i, _) in enumerate(executor.map(lambda date: core._ensure_cached_data(date, 1), dates)):
+            if (i + 1) % 30 == 0 or i + 1 == len(dates):
+                logging.info("day {}/{} loaded, {:.1f}s".format(i + 1, len(dates), time.perf_counter() - start))
+
+
+def _pool(processes):
+    # forked workers read the parent's cube without copying it, where fork is not available
+    # threads write the blocks (numpy copies and compression release the gil)
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork').Pool(processes)
+
+    logging.info("fork not available, writing blocks with threads")
+    return ThreadPool(processes)
+
+
+def extract(core, locations, date, days, output, format='npz', processes=None, block_size=BLOCK_SIZE, block_locations=BLOCK_LOCATIONS, loaders=LOADERS):
+    global _core
+
+    (ids, latitudes, longitudes) = locations
+    day_first = datetime.strptime(date, Arc2Core.DATE_FORMAT).date().toordinal()
+    idx_from = day_first - core.offset_start
+    idx_to = idx_from + days
+
+    if idx_from < 0 or idx_to > len(core.cache_content):
+        raise ValueError("date range {} + {} days not in range ({} .. {})".format(date, days, Arc2Core.CACHE_START_DATE, Arc2Core.CACHE_END_DATE))
+
+    load_days(core, date, days, loaders)
+    if not core.arc2sample:
+        raise ValueError("no arc2 data available for {} + {} days".format(date, days))
+
+    (pix_lat, pix_lng, inside) = core._lat_long_to_pixels(latitudes, longitudes)
+    if not inside.all():
+        logging.warning("skipping {} locations outside the arc2 grid: {}".format((~inside).sum(), ', '.join(ids[~inside][:10])))
+        (ids, latitudes, longitudes, pix_lat, pix_lng) = (a[inside] for a in (ids, latitudes, longitudes, pix_lat, pix_lng))
+
+    dates = numpy.array([datetime.fromordinal(day).strftime(Arc2Core.DATE_FORMAT) for day in range(day_first, day_first + days)])
+    blocks = plan_blocks(pix_lat, pix_lng, block_size, block_locations)
+    tasks = [(block, lat, lng, ids[locs], latitudes[locs], longitudes[locs], pixel_index, idx_from, idx_to, dates, output, format)
+        for (block, (lat, lng, locs, pixel_index)) in enumerate(blocks)]
+
+    logging.info("extracting {} days for {} locations on {} pixels in {} blocks".format(days, len(ids), len(numpy.unique(pix_lat * Arc2Core.SIZE_LONG + pix_lng)), len(blocks)))
+    os.makedirs(output, exist_ok=True)
+
+    _core = core
+    start = time.perf_counter()
+    done = 0
+
+    with _pool(processes) as pool:
+        for (i, (block, count)) in enumerate(pool.imap_unordered(_extract_block, tasks)):
+            done += count
+            logging.info("block {}/{} done, {}/{} locations, {:.1f}s".format(i + 1, len(tasks), done, len(ids), time.perf_counter() - start))
+
+    return done
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='extracts daily arc2 rainfall for a list of locations into compressed shards')
+    parser.add_argument('locations', help="csv file with columns 'lat', 'long' and optionally 'id'")
+    parser.add_argument('date', help='first day, format YYYYMMDD')
+    parser.add_argument('days', type=int)
+    parser.add_argument('--output', default='./extract')
+    parser.add_argument('--format', choices=FORMATS, default='npz')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes, defaults to the number of cpus')
+    parser.add_argument('--block-size', type=int, default=BLOCK_SIZE, help='max pixels per block and shard')
+    parser.add_argument('--block-locations', type=int, default=BLOCK_LOCATIONS, help='max locations per block and shard')
+    parser.add_argument('--loaders', type=int, default=LOADERS, help='threads downloading and decoding days')
+    parser.add_argument('--cache-dir', default=Arc2Core.ZIP_FOLDER, help='download folder for the zipped geotiffs')
+
+    args = parser.parse_args(argv)
+
+    core = Arc2Core(args.cache_dir)
+    extract(core, read_locations(args.locations), args.date, args.days, args.output, args.format, args.processes, args.block_size, args.block_locations, args.loaders)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,253 @@
+import argparse
+import io
+import logging
+import numpy
+import random
+import re
+import sys
+import threading
+import time
+import zipfile
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib import request
+from urllib.error import HTTPError
+from urllib.parse import urlencode, urlsplit
+
+from arc2_core import Arc2Core
+from config import configure_logging
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+configure_logging()
+
+SAMPLE_TIFF = './tests/inputs/africa_arc.20210527.tif'
+
+# synthetic query mix, weights per query kind
+QUERY_MIX = {
+    'hot': 0.55,
+    'long': 0.15,
+    'cold': 0.15,
+    'cache': 0.15,
+}
+
+# a handful of insured locations that receive most of the traffic
+HOT_LOCATIONS = [(-0.9, 37.7), (3.1, 14.7), (12.4, -1.5), (-15.4, 28.3), (9.0, 38.7)]
+
+LOG_PATTERN = re.compile(r'"GET (\S+) HTTP')
+
+
+class FtpStandIn(BaseHTTPRequestHandler):
+    """serves every requested arc2 day from the sample geotiff, optionally with a delay per download"""
+
+    delay = 0.0
+    archives = {}
+    lock = threading.Lock()
+
+    def do_GET(self):
+        filename = self.path.split('/')[-1]
+        match = re.fullmatch(Arc2Core.ZIP_FILE_TEMPLATE_ZIP.format(r'(\d{8})').replace('.', r'\.'), filename)
+
+        if not match:
+            self.send_error(404)
+            return
+
+        time.sleep(FtpStandIn.delay)
+        data = FtpStandIn._archive(match.group(1))
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+    @staticmethod
+    def _archive(date):
+        with FtpStandIn.lock:
+            if date not in FtpStandIn.archives:
+                buffer = io.BytesIO()
+                with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as z:
+                    z.write(SAMPLE_TIFF, Arc2Core.ZIP_FILE_TEMPLATE.format(date))
+                FtpStandIn.archives[date] = buffer.getvalue()
+
+            return FtpStandIn.archives[date]
+
+
+def serve_ftp_stand_in(port, delay):
+    FtpStandIn.delay = delay
+    server = ThreadingHTTPServer(('localhost', port), FtpStandIn)
+    logging.info("ftp stand-in listening on http://localhost:{}, start the server with ARC2_FTP_SERVER set to this url".format(port))
+    server.serve_forever()
+
+
+def read_query_log(file_name):
+    """reads request paths from a file, either one path per line or werkzeug/apache style access log lines"""
+    queries = []
+
+    with open(file_name) as f:
+        for line in f:
+            match = LOG_PATTERN.search(line)
+            path = match.group(1) if match else line.strip()
+
+            if path.startswith('/arc2/'):
+                queries.append(path)
+
+    return queries
+
+
+def synthetic_queries(count, seed):
+    rnd = random.Random(seed)
+    first = datetime.strptime(Arc2Core.CACHE_START_DATE, Arc2Core.DATE_FORMAT).date()
+    last = min(datetime.strptime(Arc2Core.CACHE_END_DATE, Arc2Core.DATE_FORMAT).date(), datetime.now().date())
+    span = (last - first).days
+    kinds = list(QUERY_MIX.keys())
+    weights = list(QUERY_MIX.values())
+    queries = []
+
+    for _ in range(count):
+        kind = rnd.choices(kinds, weights)[0]
+
+        if kind == 'cache':
+            date = first + timedelta(days=rnd.randrange(span))
+            queries.append('/arc2/cache?{}'.format(urlencode({'date': date.strftime(Arc2Core.DATE_FORMAT), 'days': rnd.randint(1, 30)})))
+            continue
+
+        if kind == 'hot':
+            (lat, lng) = rnd.choice(HOT_LOCATIONS)
+            days = rnd.randint(1, 30)
+            # recent days, mostly already cached
+            date = last - timedelta(days=rnd.randint(days, min(span, days + 60)))
+        elif kind == 'long':
+            (lat, lng) = (round(rnd.uniform(-35.0, 35.0), 2), round(rnd.uniform(-15.0, 50.0), 2))
+            days = rnd.randint(180, 366)
+            date = first + timedelta(days=rnd.randrange(max(1, span - days)))
+        else:
+            (lat, lng) = (round(rnd.uniform(-35.0, 35.0), 2), round(rnd.uniform(-15.0, 50.0), 2))
+            days = rnd.randint(1, 10)
+            date = first + timedelta(days=rnd.randrange(span))
+
+        params = {'lat': lat, 'long': lng, 'date': date.strftime(Arc2Core.DATE_FORMAT), 'days': days}
+        queries.append('/arc2/rainfall?{}'.format(urlencode(params)))
+
+    return queries
+
+
+def replay(base_url, queries, concurrency, timeout):
+    """sends all queries to the server using the provided number of concurrent clients, returns (wall time, samples)"""
+
+    def send(path):
+        endpoint = urlsplit(path).path
+        start = time.perf_counter()
+
+        try:
+            with request.urlopen(base_url + path, timeout=timeout) as r:
+                r.read()
+                ok = r.status == 200
+        except HTTPError:
+            ok = False
+        except Exception as e:
+            logging.warning("request {} failed: {}".format(path, e))
+            ok = False
+
+        return (endpoint, time.perf_counter() - start, ok)
+
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        samples = list(executor.map(send, queries))
+
+    return (time.perf_counter() - start, samples)
+
+
+def summarize(wall_time, samples):
+    summary = {}
+    endpoints = sorted(set(s[0] for s in samples))
+
+    for endpoint in endpoints + ['total']:
+        selected = [s for s in samples if endpoint in (s[0], 'total')]
+        latencies = numpy.array([s[1] for s in selected]) * 1000.0
+        errors = sum(1 for s in selected if not s[2])
+        (p50, p95, p99) = numpy.percentile(latencies, [50, 95, 99])
+
+        summary[endpoint] = {
+            'requests': len(selected),
+            'req/s': len(selected) / wall_time,
+            'p50 ms': p50,
+            'p95 ms': p95,
+            'p99 ms': p99,
+            'errors %': 100.0 * errors / len(selected),
+        }
+
+    return summary
+
+
+def report(summaries):
+    """prints one block per endpoint with the targets side by side"""
+    names = list(summaries.keys())
+    endpoints = []
+
+    for summary in summaries.values():
+        endpoints += [e for e in summary if e not in endpoints]
+
+    lines = []
+    for endpoint in endpoints:
+        lines.append("{:<12}{}".format(endpoint, ''.join('{:>16}'.format(name) for name in names)))
+
+        for metric in ['requests', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors %']:
+            values = [summaries[name].get(endpoint, {}).get(metric) for name in names]
+            cells = ''.join('{:>16}'.format('-' if v is None else '{:.1f}'.format(v)) for v in values)
+            lines.append("  {:<10}{}".format(metric, cells))
+
+        lines.append('')
+
+    print('\n'.join(lines))
+
+
+def parse_target(value):
+    if '=' in value:
+        (name, url) = value.split('=', 1)
+    else:
+        (name, url) = (urlsplit(value).netloc, value)
+
+    return (name, url.rstrip('/'))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='load test for the arc2 rest server')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    ftp = commands.add_parser('ftp', help='run a local stand-in for the noaa ftp server')
+    ftp.add_argument('--port', type=int, default=8021)
+    ftp.add_argument('--delay', type=float, default=0.0, help='seconds to wait before serving an archive')
+
+    run = commands.add_parser('run', help='replay queries against one or more running servers')
+    run.add_argument('--target', action='append', required=True, type=parse_target,
+        help='server to test, as url or name=url. repeat to compare configurations side by side')
+    run.add_argument('--log', help='query log to replay, request paths or access log lines')
+    run.add_argument('--requests', type=int, default=1000, help='number of synthetic queries')
+    run.add_argument('--seed', type=int, default=42)
+    run.add_argument('--concurrency', type=int, default=16)
+    run.add_argument('--timeout', type=float, default=60.0)
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'ftp':
+        serve_ftp_stand_in(args.port, args.delay)
+        return
+
+    queries = read_query_log(args.log) if args.log else synthetic_queries(args.requests, args.seed)
+    summaries = {}
+
+    for (name, url) in args.target:
+        logging.info("replaying {} queries against {} ({}) with concurrency {}".format(len(queries), name, url, args.concurrency))
+        summaries[name] = summarize(*replay(url, queries, args.concurrency, args.timeout))
+
+    report(summaries)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,185 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+from datetime import datetime
+
+from config import configure_logging
+
+class Manifest(object):
+    """index of the zipped geotiffs in the download folder
+
+    records size, sha256 checksum, source timestamp (last-modified of the ftp server)
+    and last access per day, and is stored as json next to the archives.
+    archives are evicted least recently used first once their total size exceeds the budget.
+    access times alone are saved at most every SAVE_INTERVAL seconds, other changes right away.
+    """
+
+    FILE_NAME = 'manifest.json'
+    ARCHIVE_PATTERN = re.compile(r'africa_arc\.(\d{8})\.tif\.zip')
+    TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+    # seconds between saves for access time updates
+    SAVE_INTERVAL = 60
+
+    logging.getLogger(__name__).addHandler(logging.NullHandler())
+    configure_logging()
+
+    def __init__(self, folder, budget=None):
+        super().__init__()
+
+        self.folder = folder
+        self.budget = budget
+        self.file_path = os.path.join(folder, Manifest.FILE_NAME)
+        self.lock = threading.Lock()
+        self.entries = self._load()
+        self.saved = time.monotonic()
+        self.dirty = False
+
+        logging.info("manifest for {} with {} archives, {} bytes".format(folder, len(self.entries), self.size()))
+
+
+    def get(self, date):
+        return self.entries.get(date)
+
+
+    def size(self):
+        return sum(entry['size'] for entry in self.entries.values())
+
+
+    def add(self, date, path, source_timestamp=None):
+        entry = {
+            'file': os.path.basename(path),
+            'size': os.path.getsize(path),
+            'checksum': Manifest.checksum(path),
+            'source_timestamp': source_timestamp,
+            'last_access': Manifest._now(),
+        }
+
+        with self.lock:
+            self.entries[date] = entry
+            self._save()
+
+        return entry
+
+
+    def touch(self, date):
+        with self.lock:
+            if date in self.entries:
+                self.entries[date]['last_access'] = Manifest._now()
+                self.dirty = True
+
+                if time.monotonic() - self.saved >= Manifest.SAVE_INTERVAL:
+                    self._save()
+
+
+    def flush(self):
+        with self.lock:
+            if self.dirty:
+                self._save()
+
+
+    def remove(self, date):
+        with self.lock:
+            if self.entries.pop(date, None):
+                self._save()
+
+
+    def evict(self, evictable):
+        """removes least recently used archives while over budget, evictable(date) decides which ones may go"""
+        if not self.budget:
+            return []
+
+        evicted = []
+
+        with self.lock:
+            size = self.size()
+            candidates = sorted(self.entries.items(), key=lambda item: item[1]['last_access'])
+
+            for (date, entry) in candidates:
+                if size <= self.budget:
+                    break
+
+                if not evictable(date):
+                    continue
+
+                path = os.path.join(self.folder, entry['file'])
+                if os.path.exists(path):
+                    os.remove(path)
+
+                del self.entries[date]
+                size -= entry['size']
+                evicted.append(date)
+
+            if evicted:
+                self._save()
+
+        if evicted:
+            logging.info("evicted {} archives, {} bytes left of budget {}".format(len(evicted), size, self.budget))
+        if size > self.budget:
+            logging.warning("download folder {} over budget ({} > {} bytes), remaining archives without a persisted slice".format(self.folder, size, self.budget))
+
+        return evicted
+
+
+    @staticmethod
+    def checksum(path):
+        sha = hashlib.sha256()
+
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+
+        return sha.hexdigest()
+
+
+    @staticmethod
+    def _now():
+        return datetime.now().strftime(Manifest.TIMESTAMP_FORMAT)
+
+
+    def _load(self):
+        if os.path.exists(self.file_path):
+            with open(self.file_path) as f:
+                return json.load(f)
+
+        # no manifest yet: index archives downloaded before the manifest existed
+        entries = {}
+
+        if os.path.isdir(self.folder):
+            for file in os.scandir(self.folder):
+                match = Manifest.ARCHIVE_PATTERN.fullmatch(file.name)
+
+                if match and file.is_file():
+                    entries[match.group(1)] = {
+                        'file': file.name,
+                        'size': file.stat().st_size,
+                        'checksum': Manifest.checksum(file.path),
+                        'source_timestamp': None,
+                        'last_access': datetime.fromtimestamp(file.stat().st_mtime).strftime(Manifest.TIMESTAMP_FORMAT),
+                    }
+
+            logging.info("indexed {} existing archives in {}".format(len(entries), self.folder))
+
+        return entries
+
+
+    def _save(self):
+        if not os.path.isdir(self.folder):
+            return
+
+        self.saved = time.monotonic()
+        self.dirty = False
+
+        # replace atomically, a crash never leaves a truncated manifest behind
+        (fd, tmp_file_path) = tempfile.mkstemp(dir=self.folder)
+
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+
+        os.replace(tmp_file_path, self.file_path)
@@ -0,0 +1,149 @@
+import logging
+import queue
+import threading
+import time
+
+from collections import OrderedDict, deque
+from datetime import datetime
+
+from config import configure_logging
+
+class Prefetcher(object):
+    """loads days ahead of sequential or periodic rainfall queries in the background, and days backfilled on request
+
+    request windows are tracked per pixel. a window that starts where the previous one ended
+    (sequential) or two equal strides in a row (periodic) trigger a read-ahead of the next
+    windows (at most WINDOWS), limited to max_days days per trigger and max_queued days waiting overall.
+    prefetching pauses while any demand load is in progress.
+    """
+
+    # number of windows remembered per pixel and number of pixels tracked
+    HISTORY = 3
+    MAX_KEYS = 1024
+
+    # number of windows to read ahead at most
+    WINDOWS = 4
+
+    # seconds to wait before checking again for running demand loads
+    BACKOFF = 0.05
+
+    logging.getLogger(__name__).addHandler(logging.NullHandler())
+    configure_logging()
+
+    def __init__(self, core, max_days, max_queued=None):
+        super().__init__()
+
+        self.core = core
+        self.max_days = max_days
+        self.max_queued = max_queued or 4 * max_days
+
+        self.history = OrderedDict()
+        self.queued = set()
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+
+        self.worker = threading.Thread(target=self._run, name='arc2-prefetch', daemon=True)
+        self.worker.start()
+
+        logging.info("prefetcher started. max days {}, max queued {}".format(self.max_days, self.max_queued))
+
+
+    def observe(self, key, day_first, days):
+        with self.lock:
+            windows = self.history.pop(key, None) or deque(maxlen=Prefetcher.HISTORY)
+            windows.append((day_first, days))
+            self.history[key] = windows
+
+            if len(self.history) > Prefetcher.MAX_KEYS:
+                self.history.popitem(last=False)
+
+            stride = Prefetcher._stride(windows)
+            if not stride:
+                return
+
+            for day in self._predict(day_first, days, stride):
+                self.queued.add(day)
+                self.queue.put(day)
+
+
+    def backfill(self, days):
+        """queues days that still need loading (e.g. the days of rollup periods) as far as the queue has room,
+        returns the number of days still missing"""
+        missing = [day for day in days if self.core._needs_load(day - self.core.offset_start)]
+
+        with self.lock:
+            for day in missing:
+                if len(self.queued) >= self.max_queued:
+                    break
+
+                if day not in self.queued:
+                    self.queued.add(day)
+                    self.queue.put(day)
+
+        return len(missing)
+
+
+    @staticmethod
+    def _stride(windows):
+        if len(windows) < 2:
+            return None
+
+        (start_prev, days_prev) = windows[-2]
+        (start, days) = windows[-1]
+        stride = start - start_prev
+
+        if stride <= 0:
+            return None
+
+        # sequential: current window continues the previous one
+        if stride == days_prev:
+            return stride
+
+        # periodic: same stride as between the two windows before
+        if len(windows) > 2 and windows[-2][0] - windows[-3][0] == stride:
+            return stride
+
+        return None
+
+
+    def _predict(self, day_first, days, stride):
+        day_last = min(self.core.offset_end, datetime.now().date().toordinal() - 1)
+        budget = min(self.max_days, self.max_queued - len(self.queued))
+        predicted = []
+        start = day_first + stride
+        start_last = min(day_last, day_first + Prefetcher.WINDOWS * stride)
+
+        while budget > 0 and start <= start_last:
+            for day in range(start, min(start + days, day_last + 1)):
+                if budget <= 0:
+                    break
+
+                if day in self.queued or not self.core._needs_load(day - self.core.offset_start):
+                    continue
+
+                predicted.append(day)
+                budget -= 1
+
+            start += stride
+
+        return predicted
+
+
+    def _run(self):
+        while True:
+            day = self.queue.get()
+
+            # demand fetches go first
+            while self.core.demand_loads() > 0:
+                time.sleep(Prefetcher.BACKOFF)
+
+            try:
+                if self.core._needs_load(day - self.core.offset_start):
+                    self.core._load_day(day, demand=False)
+            except Exception as e:
+                logging.warning("prefetch failed for day {}: {}".format(datetime.fromordinal(day).strftime(self.core.DATE_FORMAT), e))
+            finally:
+                with self.lock:
+                    self.queued.discard(day)
+
+                self.queue.task_done()
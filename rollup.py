@@ -0,0 +1,91 @@
+import numpy
+
+from datetime import date
+
+class Rollup(object):
+    """rainfall totals per pixel over dekads, months or seasons
+
+    totals and the number of days contributing are kept as (lat, long, period) arrays,
+    so the series of a single pixel is one contiguous read. both are updated incrementally
+    whenever a day is ingested or reloaded.
+    """
+
+    DEKAD = 'dekad'
+    MONTH = 'month'
+    SEASON = 'season'
+    PERIODS = [DEKAD, MONTH, SEASON]
+
+    # first month of each three month season (djf, mam, jja, son)
+    SEASON_MONTHS = [12, 3, 6, 9]
+
+    def __init__(self, period, day_first, day_last, shape):
+        super().__init__()
+
+        self.period = period
+
+        # period boundaries as ordinals, period i covers days starts[i] .. starts[i + 1] - 1
+        self.starts = Rollup._period_starts(period, day_first, day_last)
+        periods = len(self.starts) - 1
+
+        self.sums = numpy.zeros(shape + (periods,), dtype=numpy.float32)
+        self.counts = numpy.zeros(shape + (periods,), dtype=numpy.uint8)
+
+        # odd while an update is in progress
+        self.seq = 0
+
+
+    def period_index(self, day):
+        return int(numpy.searchsorted(self.starts, day, side='right')) - 1
+
+
+    def periods(self):
+        return len(self.starts) - 1
+
+
+    def update(self, day, old, old_valid, new, new_valid):
+        """replaces the contribution of the old slice of day by the new one"""
+        idx = self.period_index(day)
+        delta = numpy.where(new_valid, new, 0).astype(numpy.float32) - numpy.where(old_valid, old, 0).astype(numpy.float32)
+        delta_count = new_valid.astype(numpy.int8) - old_valid.astype(numpy.int8)
+
+        self.seq += 1
+        self.sums[:, :, idx] += delta
+        self.counts[:, :, idx] = (self.counts[:, :, idx] + delta_count).astype(numpy.uint8)
+        self.seq += 1
+
+
+    def read(self, lat, lng, idx_from, idx_to):
+        # lock free read, retried when an update happened meanwhile
+        while True:
+            seq = self.seq
+            sums = self.sums[lat, lng, idx_from:idx_to].copy()
+            counts = self.counts[lat, lng, idx_from:idx_to].copy()
+
+            if seq % 2 == 0 and seq == self.seq:
+                return (sums, counts)
+
+
+    @staticmethod
+    def _period_starts(period, day_first, day_last):
+        # candidate starts from the year before the first day up to the year after the last day
+        year_first = date.fromordinal(day_first).year - 1
+        year_last = date.fromordinal(day_last).year + 1
+        candidates = []
+
+        for year in range(year_first, year_last + 1):
+            for month in range(1, 13):
+                if period == Rollup.DEKAD:
+                    candidates += [date(year, month, day).toordinal() for day in [1, 11, 21]]
+                elif period == Rollup.MONTH:
+                    candidates.append(date(year, month, 1).toordinal())
+                elif period == Rollup.SEASON:
+                    if month in Rollup.SEASON_MONTHS:
+                        candidates.append(date(year, month, 1).toordinal())
+                else:
+                    raise ValueError("unknown rollup period '{}', expected one of {}".format(period, Rollup.PERIODS))
+
+        # keep the periods overlapping day_first .. day_last plus the end of the last one
+        first = max(i for i in range(len(candidates)) if candidates[i] <= day_first)
+        last = min(i for i in range(len(candidates)) if candidates[i] > day_last)
+
+        return numpy.array(candidates[first:last + 1], dtype=numpy.int64)
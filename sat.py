@@ -0,0 +1,91 @@
+import numpy
+import threading
+
+from collections import OrderedDict
+
+class SummedAreaTables(object):
+    """summed-area tables of the max_days most recently used days, least recently used tables are dropped first
+
+    tables are built when a day is ingested, a day without a table is averaged directly from the cube.
+    cube values are float16, i.e. multiples of 2^-24, so sums are kept exactly as int64 in these units
+    (4.8 MB per day) and both ways return the same means. days with missing pixels get a second table
+    with valid pixel counts (another 2.4 MB). each table is tagged with the sequence number of its slice.
+    """
+
+    # units per mm, float16 values are exact integers in these units
+    SCALE = 1 << 24
+
+    def __init__(self, max_days):
+        super().__init__()
+
+        self.max_days = max_days
+        self.tables = OrderedDict()
+        self.lock = threading.Lock()
+
+
+    def get(self, idx, seq):
+        with self.lock:
+            entry = self.tables.get(idx)
+
+            if not entry or entry[0] != seq:
+                return None
+
+            self.tables.move_to_end(idx)
+            return entry[1]
+
+
+    def put(self, idx, seq, table):
+        with self.lock:
+            self.tables[idx] = (seq, table)
+            self.tables.move_to_end(idx)
+
+            while len(self.tables) > self.max_days:
+                self.tables.popitem(last=False)
+
+
+    @staticmethod
+    def build(values, valid):
+        # tables carry a leading row and column of zeros, missing pixels are left out of sums and counts.
+        # counts are only kept for days with missing pixels
+        shape = (values.shape[0] + 1, values.shape[1] + 1)
+        sums = numpy.zeros(shape, dtype=numpy.int64)
+        sums[1:, 1:] = SummedAreaTables.units(values, valid).cumsum(axis=0).cumsum(axis=1)
+
+        counts = None
+        if not valid.all():
+            counts = numpy.zeros(shape, dtype=numpy.uint32)
+            counts[1:, 1:] = valid.astype(numpy.uint32).cumsum(axis=0).cumsum(axis=1)
+
+        return (sums, counts)
+
+
+    @staticmethod
+    def units(values, valid):
+        # max float16 (65504 mm) times the pixels of a day stays below 2^63 units
+        return (numpy.where(valid, values, 0).astype(numpy.float64) * SummedAreaTables.SCALE).astype(numpy.int64)
+
+
+    @staticmethod
+    def mean(table, lat_from, lat_to, lng_from, lng_to, no_data):
+        (sums, counts) = table
+        count = (lat_to - lat_from) * (lng_to - lng_from)
+
+        if counts is not None:
+            count = SummedAreaTables._box(counts, lat_from, lat_to, lng_from, lng_to)
+
+        return SummedAreaTables.to_mean(SummedAreaTables._box(sums, lat_from, lat_to, lng_from, lng_to), count, no_data)
+
+
+    @staticmethod
+    def to_mean(total, count, no_data):
+        # total in units, shared by table lookups and direct means
+        if count == 0:
+            return no_data
+
+        return total / SummedAreaTables.SCALE / count
+
+
+    @staticmethod
+    def _box(table, lat_from, lat_to, lng_from, lng_to):
+        # python int arithmetic, uint32 differences could wrap around
+        return int(table[lat_to, lng_to]) - int(table[lat_from, lng_to]) - int(table[lat_to, lng_from]) + int(table[lat_from, lng_from])
@@ -0,0 +1,25 @@
+import pytest
+from test_arc2_core import DAY, core, ftp_folder  # noqa: F401
+
+
+@pytest.fixture
+def client(core, monkeypatch):
+    import app
+
+    monkeypatch.setattr(app, "cache", core)
+    return app.app.test_client()
+
+
+def test_rainfall_not_modified(client):
+    query = "/arc2/rainfall?lat=3.1&long=14.7&date={}&days=1".format(DAY)
+    response = client.get(query)
+    tag = response.headers["ETag"]
+    assert response.status_code == 200
+    assert response.get_data(as_text=True) == "{} 10.5\n".format(DAY)
+
+    response = client.get(query, headers={"If-None-Match": tag})
+    assert response.status_code == 304
+    assert response.get_data() == b""
+
+    response = client.get(query, headers={"If-None-Match": '"20210527-1-0"'})
+    assert response.status_code == 200
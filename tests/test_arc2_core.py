@@ -0,0 +1,371 @@
+import numpy as np  # type: ignore
+import pytest
+import os
+import time
+import zipfile
+from arc2_core import Arc2Core
+from rollup import Rollup
+from sat import SummedAreaTables
+
+
+DAY = "20210527"
+TIFF_FILE = "./tests/inputs/africa_arc.20210527.tif"
+
+
+@pytest.fixture
+def ftp_folder(tmp_path):
+    folder = tmp_path / "ftp"
+    folder.mkdir()
+    with zipfile.ZipFile(folder / Arc2Core.ZIP_FILE_TEMPLATE_ZIP.format(DAY), "w") as z:
+        z.write(TIFF_FILE, Arc2Core.ZIP_FILE_TEMPLATE.format(DAY))
+    return folder
+
+
+@pytest.fixture
+def core(tmp_path, ftp_folder, monkeypatch):
+    download_folder = tmp_path / "data"
+    download_folder.mkdir()
+    monkeypatch.setattr(Arc2Core, "CACHE_START_DATE", "20210520")
+    monkeypatch.setattr(Arc2Core, "CACHE_END_DATE", "20210531")
+    monkeypatch.setattr(Arc2Core, "TMP_FOLDER", str(tmp_path / "tmp"))
+    monkeypatch.setattr(Arc2Core, "FTP_SERVER", ftp_folder.as_uri())
+    return Arc2Core(str(download_folder))
+
+
+def test_rainfall(core: Arc2Core):
+    assert core.rainfall(3.1, 14.7, DAY, 1) == "{} 10.5\n".format(DAY)
+    assert os.path.exists(os.path.join(core.download_folder, Arc2Core.ZIP_FILE_TEMPLATE_ZIP.format(DAY)))
+    assert os.listdir(Arc2Core.TMP_FOLDER) == []
+
+
+def test_reload_versions(core: Arc2Core):
+    idx = 7
+    core.rainfall(3.1, 14.7, DAY, 1)
+    tag = core.cache_tag(DAY, 1)
+    assert core.cache_version(idx) == 1
+
+    core._ensure_cached_data(DAY, 1, force_reload=True)
+    assert core.cache_version(idx) == 2
+    assert core.cache_tag(DAY, 1) != tag
+
+    status = core.cache_status(None, 12).split("\n")
+    assert status[idx].startswith("{} {} v2 ".format(DAY, core.cache_content[idx]))
+    assert status[0] == "20210520 initialized v0 -"
+
+
+def test_failed_reload_keeps_version(core: Arc2Core, ftp_folder):
+    idx = 7
+    core.rainfall(3.1, 14.7, DAY, 1)
+    content = core.cache_content[idx]
+    os.remove(ftp_folder / Arc2Core.ZIP_FILE_TEMPLATE_ZIP.format(DAY))
+
+    core._ensure_cached_data(DAY, 1, force_reload=True)
+    assert core.cache_version(idx) == 1
+    assert core.cache_content[idx] == content
+    assert core.rainfall(3.1, 14.7, DAY, 1) == "{} 10.5\n".format(DAY)
+
+
+def test_read_during_swap(core: Arc2Core):
+    idx = 7
+    (lat, lng) = (10, 20)
+    core._swap_day(idx, np.ones((Arc2Core.SIZE_LAT, Arc2Core.SIZE_LONG)), "first")
+
+    # simulate a swap in progress: cube already partially overwritten
+    core._cache_shadow[idx] = core.cache[:, :, idx].copy()
+    core._cache_seq[idx] += 1
+    core.cache[lat, lng, idx] = 2.0
+
+    (values, seq) = core._read_pixel(lat, lng, idx, idx + 1)
+    assert values[0] == 1.0
+
+    # the tag reflects the version that was read, not the one being swapped in
+    assert core.cache_tag("20210527", 1, seq) == '"20210527-1-1"'
+    core._cache_seq[idx] += 1
+    assert core.cache_tag("20210527", 1) == '"20210527-1-2"'
+
+
+@pytest.mark.parametrize("sat_days", [0, 2])
+def test_neighbourhood_mean(core: Arc2Core, sat_days):
+    idx = 7
+    core.cache_sat = SummedAreaTables(sat_days) if sat_days else None
+    core.rainfall(3.1, 14.7, DAY, 1)
+    (lat, lng) = core._lat_long_to_pixel(3.1, 14.7)
+    if sat_days:
+        assert core.cache_sat.get(idx, 2) is not None
+
+    for radius in [1, 3]:
+        box = core.cache[lat - radius:lat + radius + 1, lng - radius:lng + radius + 1, idx].astype(np.float64)
+        mean = core._read_neighbourhood(lat, lng, radius, idx, idx + 1)[0][0]
+        assert mean == pytest.approx(box.mean(), rel=1e-12)
+
+    assert core.rainfall(3.1, 14.7, DAY, 2, radius=1).split("\n")[1] == "20210528 999.0"
+
+
+def test_neighbourhood_same_with_tables(core: Arc2Core):
+    idx = 7
+    core.rainfall(3.1, 14.7, DAY, 1)
+    (lat, lng) = core._lat_long_to_pixel(3.1, 14.7)
+    direct = [core._read_neighbourhood(lat, lng, radius, idx, idx + 1)[0][0] for radius in range(6)]
+
+    core.cache_sat = SummedAreaTables(1)
+    core._ensure_cached_data(DAY, 1, force_reload=True)
+    assert core.cache_sat.get(idx, 4) is not None
+    assert [core._read_neighbourhood(lat, lng, radius, idx, idx + 1)[0][0] for radius in range(6)] == direct
+
+
+@pytest.mark.parametrize("sat_days", [0, 2])
+def test_neighbourhood_missing_pixels(core: Arc2Core, sat_days):
+    idx = 3
+    core.cache_sat = SummedAreaTables(sat_days) if sat_days else None
+    data = np.ones((Arc2Core.SIZE_LAT, Arc2Core.SIZE_LONG))
+    data[1, 1] = Arc2Core.NO_DATA
+    data[0, 0:2] = 4.0
+    core._swap_day(idx, data, "synthetic")
+
+    # corner neighbourhood is clipped to 2x2 pixels, one of them missing
+    assert core._read_neighbourhood(0, 0, 1, idx, idx + 1)[0][0] == pytest.approx(3.0)
+
+    data[0:3, 0:3] = Arc2Core.NO_DATA
+    core._swap_day(idx, data, "synthetic")
+    assert core._read_neighbourhood(1, 1, 1, idx, idx + 1)[0][0] == Arc2Core.NO_DATA
+
+
+def test_prefetch_sequential(core: Arc2Core, ftp_folder):
+    for day in range(20, 32):
+        date = "202105{}".format(day)
+        with zipfile.ZipFile(ftp_folder / Arc2Core.ZIP_FILE_TEMPLATE_ZIP.format(date), "w") as z:
+            z.write(TIFF_FILE, Arc2Core.ZIP_FILE_TEMPLATE.format(date))
+
+    core = Arc2Core(core.download_folder, prefetch_days=4)
+    core.rainfall(3.1, 14.7, "20210520", 2)
+    core.rainfall(3.1, 14.7, "20210522", 2)
+    core.prefetcher.queue.join()
+
+    loaded = [content != Arc2Core.CACHE_INITIALIZED for content in core.cache_content]
+    assert loaded == 8 * [True] + 4 * [False]
+
+
+def test_manifest_restart(core: Arc2Core, ftp_folder):
+    idx = 7
+    core.rainfall(3.1, 14.7, DAY, 1)
+    entry = core.manifest.get(DAY)
+    assert entry["size"] > 0 and entry["checksum"] and entry["source_timestamp"]
+
+    os.remove(ftp_folder / Arc2Core.ZIP_FILE_TEMPLATE_ZIP.format(DAY))
+    restarted = Arc2Core(core.download_folder)
+    assert restarted.cache_content[idx].startswith(Arc2Core.CACHE_ARCHIVED + " ")
+    assert restarted.rainfall(3.1, 14.7, DAY, 1) == "{} 10.5\n".format(DAY)
+    assert restarted.cache_content[idx] == core.cache_content[idx]
+
+
+def test_manifest_checksum_mismatch(core: Arc2Core):
+    core.rainfall(3.1, 14.7, DAY, 1)
+    zip_file = core.cache_content[7]
+    with open(zip_file, "ab") as f:
+        f.write(b"garbage")
+
+    restarted = Arc2Core(core.download_folder)
+    assert restarted.rainfall(3.1, 14.7, DAY, 1) == "{} 10.5\n".format(DAY)
+    assert restarted.manifest.get(DAY)["checksum"] == core.manifest.get(DAY)["checksum"]
+
+
+def test_manifest_eviction(core: Arc2Core, ftp_folder):
+    idx = 7
+    core.manifest.budget = 1
+    core.rainfall(3.1, 14.7, DAY, 1)
+
+    # archive evicted once the slice is persisted, the day is marked as evicted
+    slice_path = core._slice_path(DAY)
+    assert core.manifest.get(DAY) is None
+    assert not os.path.exists(os.path.join(core.download_folder, Arc2Core.ZIP_FILE_TEMPLATE_ZIP.format(DAY)))
+    assert core.cache_content[idx] == "{} {}".format(Arc2Core.CACHE_EVICTED, slice_path)
+    assert not core._needs_load(idx)
+    assert core.rainfall(3.1, 14.7, DAY, 1) == "{} 10.5\n".format(DAY)
+
+    # after a restart the day is loaded from its slice, without downloading it again
+    os.remove(ftp_folder / Arc2Core.ZIP_FILE_TEMPLATE_ZIP.format(DAY))
+    restarted = Arc2Core(core.download_folder, disk_budget=1)
+    restarted.arc2sample = core.arc2sample
+    assert restarted._needs_load(idx)
+    assert restarted.rainfall(3.1, 14.7, DAY, 1) == "{} 10.5\n".format(DAY)
+    assert restarted.cache_content[idx] == core.cache_content[idx]
+
+
+def test_manifest_no_eviction_without_slice(core: Arc2Core):
+    core.rainfall(3.1, 14.7, DAY, 1)
+
+    # day in memory only, its archive is the only copy on disk
+    core.manifest.budget = 1
+    assert core.manifest.evict(core._archive_evictable) == []
+    assert core.manifest.get(DAY) is not None
+
+
+def test_manifest_deferred_touch(core: Arc2Core):
+    from manifest import Manifest
+
+    core.rainfall(3.1, 14.7, DAY, 1)
+    saved = os.path.getmtime(core.manifest.file_path)
+    core.manifest.touch(DAY)
+    assert core.manifest.dirty and os.path.getmtime(core.manifest.file_path) == saved
+
+    core.manifest.flush()
+    assert not core.manifest.dirty
+    assert Manifest(core.download_folder).get(DAY) == core.manifest.get(DAY)
+
+
+def test_rollups(core: Arc2Core):
+    (lat, lng) = (10, 20)
+    core = Arc2Core(core.download_folder, rollups=Rollup.PERIODS)
+    core.rainfall(3.1, 14.7, DAY, 1)
+    data = np.ones((Arc2Core.SIZE_LAT, Arc2Core.SIZE_LONG))
+    for idx in range(12):
+        core._swap_day(idx, data, "synthetic")
+
+    assert core.rollup(3.1, 14.7, "month", "20210515", 3) == "20210501 12.0 12/31\n"
+    assert core.rollup(3.1, 14.7, "season", "20210301", 1) == "20210301 12.0 12/92\n"
+
+    data[lat, lng] = Arc2Core.NO_DATA
+    core._swap_day(0, 3 * np.ones((Arc2Core.SIZE_LAT, Arc2Core.SIZE_LONG)), "reload")
+    core._swap_day(11, data, "reload")
+
+    (sums, counts) = core.rollups["dekad"].read(lat, lng, 0, 2)
+    assert list(sums) == [3.0, 10.0]
+    assert list(counts) == [1, 10]
+
+
+def test_events(core: Arc2Core):
+    after = core.events.last_id
+    assert core.events.wait(after, timeout=0) == ([], False)
+
+    core.rainfall(3.1, 14.7, DAY, 2)
+    (events, reset) = core.events.wait(after, timeout=0)
+    assert not reset
+
+    assert [data.split(" ")[0] for (id, data) in events] == [DAY, "20210528"]
+    assert events[0][1] == "{} {}".format(DAY, core.cache_status(None, 12).split("\n")[7].split(" ", 1)[1])
+
+
+def test_extract(core: Arc2Core, tmp_path):
+    import extract
+
+    locations = tmp_path / "locations.csv"
+    locations.write_text("id,lat,long\na,3.1,14.7\nb,3.1,14.7\nc,-0.9,37.7\nd,60.0,14.7\n")
+    output = tmp_path / "extract"
+
+    core.rainfall(3.1, 14.7, DAY, 1)
+    (pix_lat, pix_lng, inside) = core._lat_long_to_pixels([3.1, -0.9], [14.7, 37.7])
+    assert list(zip(pix_lat, pix_lng)) == [core._lat_long_to_pixel(3.1, 14.7), core._lat_long_to_pixel(-0.9, 37.7)]
+
+    done = extract.extract(core, extract.read_locations(str(locations)), "20210526", 2, str(output), processes=2, block_size=1)
+    assert done == 3
+    assert sorted(os.listdir(output)) == ["rainfall-00000.npz", "rainfall-00001.npz"]
+
+    shards = [np.load(output / name) for name in sorted(os.listdir(output))]
+    rows = {i: (shard["rainfall"][n], shard["date"]) for shard in shards for (n, i) in enumerate(shard["id"])}
+    assert list(rows["a"][0]) == [999.0, 10.5]
+    assert list(rows["b"][0]) == [999.0, 10.5]
+    assert list(rows["a"][1]) == ["20210526", "20210527"]
+    assert rows["c"][0][1] == float(core.rainfall(-0.9, 37.7, DAY, 1).split()[1])
+
+
+def test_extract_plan_blocks():
+    from extract import plan_blocks
+
+    # five locations on pixel (1, 2), one on (0, 5) and one on (3, 0)
+    pix_lat = np.array([1, 1, 0, 1, 1, 3, 1])
+    pix_lng = np.array([2, 2, 5, 2, 2, 0, 2])
+    blocks = plan_blocks(pix_lat, pix_lng, block_size=2, block_locations=3)
+
+    # blocks are bounded by locations as well, the crowded pixel is spread over two blocks
+    assert [len(locations) for (_, _, locations, _) in blocks] == [3, 3, 1]
+    assert [list(zip(lat, lng)) for (lat, lng, _, _) in blocks] == [[(0, 5), (1, 2)], [(1, 2)], [(3, 0)]]
+
+    for (lat, lng, locations, pixel_index) in blocks:
+        assert list(lat[pixel_index]) == list(pix_lat[locations])
+        assert list(lng[pixel_index]) == list(pix_lng[locations])
+
+    assert sorted(np.concatenate([locations for (_, _, locations, _) in blocks])) == list(range(7))
+
+
+def test_sat_lru(core: Arc2Core):
+    core.cache_sat = SummedAreaTables(2)
+    data = np.ones((Arc2Core.SIZE_LAT, Arc2Core.SIZE_LONG))
+    for idx in range(3):
+        core._swap_day(idx, (idx + 1) * data, "synthetic")
+
+    # tables are built at ingest, the least recently used one is dropped
+    assert list(core.cache_sat.tables.keys()) == [1, 2]
+    assert core.cache_sat.tables[2][1][0].dtype == np.int64
+
+    # days without a table are averaged from the cube, queries never build tables
+    assert core._read_neighbourhood(5, 5, 2, 0, 3)[0].tolist() == [1.0, 2.0, 3.0]
+    assert list(core.cache_sat.tables.keys()) == [1, 2]
+
+    # reloaded day replaces its table
+    core._swap_day(2, 5 * data, "reload")
+    assert core.cache_sat.tables[2][0] == 4
+    assert core._read_neighbourhood(5, 5, 2, 2, 3)[0][0] == 5.0
+
+
+def test_waiting_load_takes_over(core: Arc2Core):
+    import threading
+
+    idx = 7
+    day = core.offset_start + idx
+
+    # in-flight load that ends without filling the day, like a failed prefetch
+    loading = core._cache_loading[idx] = threading.Event()
+    waiter = threading.Thread(target=core._load_day, args=(day,))
+    waiter.start()
+    time.sleep(0.2)
+    del core._cache_loading[idx]
+    loading.set()
+    waiter.join()
+    assert core.cache_version(idx) == 1
+
+    # reload requested while another load of the day is in flight
+    loading = core._cache_loading[idx] = threading.Event()
+    waiter = threading.Thread(target=core._load_day, args=(day, True))
+    waiter.start()
+    time.sleep(0.2)
+    del core._cache_loading[idx]
+    loading.set()
+    waiter.join()
+    assert core.cache_version(idx) == 2
+    assert core.demand_loads() == 0
+
+
+def test_events_resume(monkeypatch):
+    from events import EventHub
+
+    monkeypatch.setattr(EventHub, "HISTORY", 3)
+    hub = EventHub()
+
+    # id from before a server restart
+    assert hub.wait(500, timeout=0) == ([], True)
+
+    for i in range(5):
+        hub.publish("event {}".format(i + 1))
+
+    assert hub.wait(3, timeout=0) == ([(4, "event 4"), (5, "event 5")], False)
+    assert hub.wait(2, timeout=0) == ([(3, "event 3"), (4, "event 4"), (5, "event 5")], False)
+    assert hub.wait(5, timeout=0) == ([], False)
+
+    # events 2 and older are gone, resumes from the oldest kept
+    assert hub.wait(1, timeout=0) == ([(3, "event 3"), (4, "event 4"), (5, "event 5")], True)
+    assert hub.wait(500, timeout=0) == ([(3, "event 3"), (4, "event 4"), (5, "event 5")], True)
+
+
+def test_rollup_backfill(core: Arc2Core):
+    # fresh process: nothing loaded, no geotiff to map locations yet
+    core = Arc2Core(core.download_folder, rollups=[Rollup.MONTH])
+    with pytest.raises(ValueError):
+        core.rollup(3.1, 14.7, "month", "20210501", 1)
+
+    # the request queued the days of may in the background instead of loading them
+    core.prefetcher.queue.join()
+    assert core.cache_version(7) == 1
+    assert core.rollup(3.1, 14.7, "month", "20210501", 1) == "20210501 10.5 1/31\n"
+
+    # days missing on the server are queued again
+    core.prefetcher.queue.join()
@@ -0,0 +1,50 @@
+import pytest
+from urllib.parse import parse_qs, urlsplit
+
+import loadtest
+
+
+def test_summarize():
+    samples = [("/arc2/rainfall", 0.010 * (i + 1), i != 3) for i in range(10)] + [("/arc2/cache", 0.002, True), ("/arc2/cache", 0.004, False)]
+    summary = loadtest.summarize(2.0, samples)
+
+    assert list(summary.keys()) == ["/arc2/cache", "/arc2/rainfall", "total"]
+    assert [summary[e]["requests"] for e in summary] == [2, 10, 12]
+    assert [summary[e]["req/s"] for e in summary] == [1.0, 5.0, 6.0]
+    assert [summary[e]["errors %"] for e in summary] == [50.0, 10.0, pytest.approx(100.0 * 2 / 12)]
+
+    # latencies 10, 20 .. 100 ms, linear interpolation between the closest ranks
+    rainfall = summary["/arc2/rainfall"]
+    assert (rainfall["p50 ms"], rainfall["p95 ms"], rainfall["p99 ms"]) == pytest.approx((55.0, 95.5, 99.1))
+    assert summary["/arc2/cache"]["p50 ms"] == pytest.approx(3.0)
+    assert summary["total"]["p50 ms"] == pytest.approx(45.0)
+
+
+def test_report(capsys):
+    summaries = {
+        "a": loadtest.summarize(1.0, [("/arc2/rainfall", 0.001, True)]),
+        "b": loadtest.summarize(1.0, [("/arc2/cache", 0.002, True)]),
+    }
+    loadtest.report(summaries)
+    blocks = [block.split("\n") for block in capsys.readouterr().out.strip().split("\n\n")]
+
+    # endpoints in order of appearance, missing ones shown as '-'
+    assert [block[0].split() for block in blocks] == [[endpoint, "a", "b"] for endpoint in ["/arc2/rainfall", "total", "/arc2/cache"]]
+    assert blocks[0][1].split() == ["requests", "1.0", "-"]
+    assert blocks[1][3].split() == ["p50", "ms", "1.0", "2.0"]
+    assert blocks[2][1].split() == ["requests", "-", "1.0"]
+
+
+def test_synthetic_queries():
+    queries = loadtest.synthetic_queries(200, seed=7)
+    assert queries == loadtest.synthetic_queries(200, seed=7)
+
+    for query in queries:
+        (path, params) = (urlsplit(query).path, parse_qs(urlsplit(query).query))
+        assert path in ["/arc2/rainfall", "/arc2/cache"]
+
+        if path == "/arc2/rainfall":
+            assert -40.0 <= float(params["lat"][0]) <= 40.0 and -20.0 <= float(params["long"][0]) <= 55.0
+            assert 1 <= int(params["days"][0]) <= 366
+        else:
+            assert 1 <= int(params["days"][0]) <= 30